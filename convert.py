@@ -1,24 +1,32 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
 import sys
 import os
-from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, features
 
+_EXTENSIONS = frozenset({'.png', '.jpg', '.jpeg'})
 
-def add_watermark(image: Image.Image, watermark_image_path: str, transparency: int) -> Image.Image:
-    """Applies a resized watermark to the center of an image with adjustable transparency.
+
+@functools.lru_cache(maxsize=8)
+def _prepared_watermark(watermark_image_path: str, transparency: int, base_width: int, base_height: int) -> Image.Image:
+    """Loads a watermark, fits it within the base image size and applies the transparency.
+
+    The result is cached, so a batch of equally sized images decodes and scales the watermark only once.
+    The returned image is shared between calls and must not be modified.
 
     Arguments:
-        image (Image.Image): The PIL Image object of the base image.
         watermark_image_path (str): The path to the watermark image.
         transparency (int): The transparency level of the watermark (0 to 255; 0 is fully transparent, 255 is fully opaque).
-    
+        base_width (int): Width of the image the watermark will be applied to.
+        base_height (int): Height of the image the watermark will be applied to.
+
     Returns:
-        Image.Image: The watermarked image.
+        Image.Image: The RGBA watermark, ready to be pasted.
     """
     watermark = Image.open(watermark_image_path)
-    base_width, base_height = image.size
 
     # Convert the watermark image to RGBA if not already
     if (watermark.mode != 'RGBA'):
@@ -29,27 +37,72 @@ def add_watermark(image: Image.Image, watermark_image_path: str, transparency: i
     if (watermark_width > base_width or watermark_height > base_height):
         scale = min(base_width / watermark_width, base_height / watermark_height)
         new_size = (int(watermark_width * scale), int(watermark_height * scale))
-        watermark = watermark.resize(new_size, Image.ANTIALIAS)
+        # Watermarks are mostly flat logos, so bicubic looks the same as Lanczos at a fraction of the cost
+        watermark = watermark.resize(new_size, Image.Resampling.BICUBIC)
 
     # Adjust the watermark transparency
-    alpha = watermark.split()[3]  # Get the alpha channel
-    alpha = alpha.point(lambda p: p * transparency / 255)
+    lut = bytes((p * transparency) // 255 for p in range(256))
+    alpha = watermark.getchannel('A').point(lut)
     watermark.putalpha(alpha)
 
+    # Pasting the watermark onto a transparent layer with itself as the mask scales every channel,
+    # alpha included, by its alpha. That is the look the script has always produced, so it is baked
+    # into the cached watermark once instead of being redone on a full-size layer for every image.
+    layer = Image.new('RGBA', watermark.size, (0, 0, 0, 0))
+    layer.paste(watermark, (0, 0), watermark)
+    return layer
+
+
+def add_watermark(image: Image.Image, watermark_image_path: str, transparency: int) -> Image.Image:
+    """Applies a resized watermark to the center of an image with adjustable transparency.
+
+    Arguments:
+        image (Image.Image): The PIL Image object of the base image.
+        watermark_image_path (str): The path to the watermark image.
+        transparency (int): The transparency level of the watermark (0 to 255; 0 is fully transparent, 255 is fully opaque).
+    
+    Returns:
+        Image.Image: The watermarked image. RGB images are watermarked in place and returned as is.
+    """
+    # A fully transparent watermark leaves the image unchanged
+    if transparency == 0:
+        return image if image.mode == 'RGB' else image.convert('RGB')
+
+    base_width, base_height = image.size
+    watermark = _prepared_watermark(watermark_image_path, transparency, base_width, base_height)
+
     # Calculate the position for the watermark: centered
     watermark_width, watermark_height = watermark.size
     position = ((base_width - watermark_width) // 2, (base_height - watermark_height) // 2)
 
-    # Create a transparent layer the size of the base image
-    transparent = Image.new('RGBA', image.size, (0, 0, 0, 0))
-    # Paste the watermark in the center
-    transparent.paste(watermark, position, watermark)
-    # Blend with the base image
-    watermarked_image = Image.alpha_composite(image.convert('RGBA'), transparent)
+    # Blend the watermark into the center, using its own alpha as the mask.
+    # RGB bases are blended in place, skipping the round trip through RGBA.
+    if image.mode == 'RGB':
+        image.paste(watermark, position, watermark)
+        return image
+    # Other bases may carry transparency of their own, so composite the watermark over them,
+    # touching only the watermark's box
+    watermarked_image = image.convert('RGBA')
+    watermarked_image.alpha_composite(watermark, dest=position)
     return watermarked_image.convert('RGB')
 
 
-def convert_to_webp(base_image: Image.Image, filename: str, dimensions: tuple, quality: int, prefix: str) -> str:
+def _webp_filename(filename: str, prefix: str) -> str:
+    """Derives the output path of a converted file.
+
+    Arguments:
+        filename (str): Name of the original file.
+        prefix (str): Prefix to add to the file name.
+
+    Returns:
+        str: Path of the webp file inside ./webp
+    """
+    # Splitting filename to remove extension and add prefix
+    base_filename = os.path.splitext(os.path.basename(filename))[0]
+    return f"./webp/{prefix}{base_filename}.webp"
+
+
+def convert_to_webp(base_image: Image.Image, filename: str, dimensions: tuple, quality: int, prefix: str, method: int = 4, exact: bool = False, alpha_quality: int = 100) -> str:
     """Converts and resizes a PIL Image object to webp, saving locally with specified quality and filename prefix.
 
     Arguments:
@@ -58,20 +111,73 @@ def convert_to_webp(base_image: Image.Image, filename: str, dimensions: tuple, q
         dimensions (tuple): A tuple containing dimensions to resize the image to. Example: (500, 333)
         quality (int): Image quality for the output file.
         prefix (str): Prefix to add to the file name when saved.
+        method (int): WebP encoder effort (0 to 6; higher is slower but produces slightly smaller files).
+        exact (bool): Preserve the RGB values of fully transparent pixels instead of discarding them.
+        alpha_quality (int): Quality of the alpha channel (0 to 100), for images that have one.
     
     Returns:
         str: Newly saved file's filename
     """
-    base_image.thumbnail(dimensions)
+    # reducing_gap pre-shrinks large images with a cheap box filter before the Lanczos pass
+    base_image.thumbnail(dimensions, resample=Image.Resampling.LANCZOS, reducing_gap=2.0)
     
-    # Splitting filename to remove extension and add prefix
-    base_filename = os.path.splitext(os.path.basename(filename))[0]
-    new_filename = f"./webp/{prefix}{base_filename}.webp"
-    base_image.save(new_filename, format="webp", optimize=True, quality=quality, method=6)
+    new_filename = _webp_filename(filename, prefix)
+    # optimize has no effect on webp; method is its encoder effort setting
+    base_image.save(new_filename, format="webp", quality=quality, method=method,
+                    exact=exact, alpha_quality=alpha_quality)
     
     return new_filename
 
 
+def _process_one(file: str, options: dict) -> tuple:
+    """Watermarks (optionally) and converts a single file to webp.
+
+    Kept at module level so it can be pickled and run in a worker process.
+
+    Arguments:
+        file (str): Path to the image to convert.
+        options (dict): The parsed command-line arguments, as returned by vars().
+
+    Returns:
+        tuple: (original size in bytes, new size in bytes, new filename)
+    """
+    # Close the file and release the decoded buffers as soon as this file is done
+    with Image.open(file) as original_image:
+        if original_image.format == 'JPEG':
+            # Let libjpeg scale down while decoding; leave twice the target size for the final thumbnail pass
+            original_image.draft('RGB', (options['width'] * 2, options['height'] * 2))
+        if options['watermark']:
+            processed_image = add_watermark(original_image, options['watermark'], options['transparency'])
+        else:
+            processed_image = original_image
+        new_filename = convert_to_webp(processed_image, file, (options['width'], options['height']), options['quality'], options['prefix'],
+                                       options['method'], options['exact'], options['alpha_quality'])
+    return os.path.getsize(file), os.path.getsize(new_filename), new_filename
+
+
+def _int_range(low: int, high: int):
+    """Builds an argparse type that accepts integers between low and high, inclusive.
+
+    Unlike choices, a bad value is reported with the range instead of every allowed number.
+
+    Arguments:
+        low (int): Smallest accepted value.
+        high (int): Largest accepted value.
+
+    Returns:
+        callable: The converter to pass as type= to add_argument.
+    """
+    def convert(value: str) -> int:
+        try:
+            number = int(value)
+        except ValueError:
+            number = None
+        if number is None or not low <= number <= high:
+            raise argparse.ArgumentTypeError(f"must be an integer between {low} and {high}")
+        return number
+    return convert
+
+
 def main():
     parser = argparse.ArgumentParser(description='Convert images to WEBP format with optional watermarking, specified quality and filename prefix.')
     parser.add_argument('files', nargs='+', help='Files to convert')
@@ -80,23 +186,43 @@ def main():
     parser.add_argument('--width', type=int, default=1024, help='Width to resize the image to')
     parser.add_argument('--height', type=int, default=1024, help='Height to resize the image to')
     parser.add_argument('--watermark', type=str, help='Path to the watermark image (optional)')
-    parser.add_argument('--transparency', type=int, default=128, help='Transparency of the watermark (0 to 255)')
+    parser.add_argument('--transparency', type=_int_range(0, 255), default=128, help='Transparency of the watermark (0 to 255)')
+    parser.add_argument('--method', type=int, default=4, choices=range(0, 7), help='WEBP encoder effort (0 to 6). 6 gives files a few percent smaller but takes about twice as long as 4')
+    parser.add_argument('--exact', action='store_true', help='Preserve the RGB values of fully transparent pixels')
+    parser.add_argument('--alpha-quality', type=_int_range(0, 100), default=100, help='Quality of the alpha channel of transparent images (0 to 100)')
     args = parser.parse_args()
 
     if not os.path.isdir('./webp'):
         os.mkdir('./webp')
 
+    # Workers run concurrently, so two inputs must never be written to the same output file
+    files, outputs, has_jpeg = [], {}, False
     for file in args.files:
-        if file.endswith('.png') or file.endswith('.jpg'):
-            original_image = Image.open(file)
-            if args.watermark:
-                processed_image = add_watermark(original_image, args.watermark, args.transparency)
-            else:
-                processed_image = original_image
-            new_filename = convert_to_webp(processed_image, file, (args.width, args.height), args.quality, args.prefix)
+        extension = os.path.splitext(file)[1].lower()
+        if extension not in _EXTENSIONS:
+            print(f"Skipping {file}: unsupported extension")
+            continue
+        new_filename = os.path.normcase(_webp_filename(file, args.prefix))
+        if new_filename in outputs:
+            print(f"Skipping {file}: {outputs[new_filename]} is already converted to the same output file")
+            continue
+        outputs[new_filename] = file
+        files.append(file)
+        has_jpeg = has_jpeg or extension != '.png'
+
+    if has_jpeg and not features.check_feature('libjpeg_turbo'):
+        print('Warning: Pillow is not built against libjpeg-turbo, JPEG decoding will be slower.', file=sys.stderr)
+
+    # Each file is an independent, CPU-bound encode, so spread them over one process per core
+    total_original, total_new = 0, 0
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        process = functools.partial(_process_one, options=vars(args))
+        for file, (original_size, new_size, new_filename) in zip(files, executor.map(process, files, chunksize=1)):
+            total_original += original_size
+            total_new += new_size
             print(f"Processed {file} -> {new_filename}")
 
-    print('Conversion complete.')
+    print(f'Conversion complete. {total_original} bytes -> {total_new} bytes.')
 
 if __name__ == '__main__':
     main()